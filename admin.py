@@ -0,0 +1,115 @@
+from product import app
+from flask import request, jsonify, g
+import cProfile
+import pstats
+import threading
+from tracing import start_span, end_span
+
+# ----------------- REQUEST TRACING -----------------
+
+@app.before_request
+def start_request_span():
+    rule = request.url_rule.rule if request.url_rule else request.path
+    g.request_span = start_span(f"{request.method} {rule}", route=rule, method=request.method)
+
+
+@app.teardown_request
+def end_request_span(error=None):
+    request_span = g.pop("request_span", None)
+    if request_span is not None:
+        end_span(request_span, error)
+
+
+# ----------------- ON-DEMAND PROFILING -----------------
+
+# Profiling is armed for one route at a time and collects the next N requests
+profile_state = {
+    "route": None,
+    "remaining": 0,
+    "profiled": 0,
+    "stats": None
+}
+_profile_lock = threading.Lock()
+# cProfile hooks the interpreter, so only one request is profiled at a time
+_profiler_busy = threading.Lock()
+
+
+def _matches_profiled_route():
+    route = profile_state["route"]
+    if route is None or profile_state["remaining"] <= 0:
+        return False
+    rule = request.url_rule.rule if request.url_rule else None
+    return route in (rule, request.path)
+
+
+@app.before_request
+def start_profiling():
+    with _profile_lock:
+        if not _matches_profiled_route() or not _profiler_busy.acquire(blocking=False):
+            return
+        profile_state["remaining"] -= 1
+
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+@app.teardown_request
+def stop_profiling(error=None):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return
+    profiler.disable()
+    _profiler_busy.release()
+
+    with _profile_lock:
+        if profile_state["stats"] is None:
+            profile_state["stats"] = pstats.Stats(profiler)
+        else:
+            profile_state["stats"].add(profiler)
+        profile_state["profiled"] += 1
+
+
+def _profile_report(limit):
+    stats = profile_state["stats"]
+    if stats is None:
+        return []
+
+    rows = []
+    for (filename, line, function), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            "function": f"{filename}:{line}({function})",
+            "calls": ncalls,
+            "totalTime": round(tottime, 6),
+            "cumulativeTime": round(cumtime, 6)
+        })
+    rows.sort(key=lambda row: row["cumulativeTime"], reverse=True)
+    return rows[:limit]
+
+
+@app.route("/admin/profile", methods=["POST"])
+def arm_profiling():
+    data = request.get_json() or {}
+    route = data.get("route")
+    count = data.get("requests", 10)
+
+    if not route or not isinstance(route, str):
+        return jsonify({"error": "route is required, e.g. /processOrder"}), 400
+    if not isinstance(count, int) or count <= 0:
+        return jsonify({"error": "requests must be a positive integer"}), 400
+
+    with _profile_lock:
+        profile_state.update(route=route, remaining=count, profiled=0, stats=None)
+
+    return jsonify({"message": f"Profiling next {count} requests to {route}"}), 200
+
+
+@app.route("/admin/profile", methods=["GET"])
+def get_profile():
+    limit = request.args.get("limit", 50, type=int)
+    with _profile_lock:
+        return jsonify({
+            "route": profile_state["route"],
+            "profiledRequests": profile_state["profiled"],
+            "remainingRequests": profile_state["remaining"],
+            "functions": _profile_report(limit)
+        }), 200
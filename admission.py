@@ -0,0 +1,145 @@
+from product import app
+from flask import request, jsonify, g
+import threading
+import time
+
+# ----------------- ADMISSION CONTROL FOR WRITE ROUTES -----------------
+
+# Write requests share TOTAL_WRITE_SLOTS concurrent DB-bound slots. Each route
+# class has its own concurrency limit, a short bounded wait queue and a maximum
+# wait; when slots free up, queued sales are admitted before batch and admin
+# writes.
+TOTAL_WRITE_SLOTS = 16
+ROUTE_CLASSES = {
+    # class: (priority, concurrency limit, queue length, max wait seconds)
+    "sales": (0, 16, 32, 2.0),
+    "batch": (1, 6, 8, 1.0),
+    "admin": (2, 2, 4, 1.0)
+}
+RETRY_AFTER_SECONDS = 1
+
+
+class AdmissionController:
+    def __init__(self, total_slots, classes):
+        self.total_slots = total_slots
+        self.classes = classes
+        self.by_priority = sorted(classes, key=lambda name: classes[name][0])
+        self._cond = threading.Condition()
+        self._in_use = 0
+        self._queues = {name: [] for name in classes}
+        self._stats = {
+            name: {"inFlight": 0, "admitted": 0, "rejected": 0, "timedOut": 0, "maxQueueDepth": 0}
+            for name in classes
+        }
+
+    def _has_slot(self, name):
+        return (self._in_use < self.total_slots
+                and self._stats[name]["inFlight"] < self.classes[name][1])
+
+    def _next_class(self):
+        """
+        Highest priority class with a queued request that could run now
+        """
+        for name in self.by_priority:
+            if self._queues[name] and self._has_slot(name):
+                return name
+        return None
+
+    def _grant(self, name):
+        self._in_use += 1
+        self._stats[name]["inFlight"] += 1
+        self._stats[name]["admitted"] += 1
+
+    def acquire(self, name):
+        """
+        Wait for a slot for the given class; returns False if rejected
+        """
+        priority, _, queue_length, max_wait = self.classes[name]
+        with self._cond:
+            next_class = self._next_class()
+            if self._has_slot(name) and (next_class is None or self.classes[next_class][0] > priority):
+                self._grant(name)
+                return True
+
+            queue = self._queues[name]
+            if len(queue) >= queue_length:
+                self._stats[name]["rejected"] += 1
+                return False
+
+            ticket = object()
+            queue.append(ticket)
+            stats = self._stats[name]
+            stats["maxQueueDepth"] = max(stats["maxQueueDepth"], len(queue))
+            deadline = time.monotonic() + max_wait
+            while True:
+                if queue[0] is ticket and self._next_class() == name:
+                    queue.pop(0)
+                    self._grant(name)
+                    # Another queued request may also be able to run now
+                    self._cond.notify_all()
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    queue.remove(ticket)
+                    stats["timedOut"] += 1
+                    self._cond.notify_all()
+                    return False
+                self._cond.wait(remaining)
+
+    def release(self, name):
+        with self._cond:
+            self._in_use -= 1
+            self._stats[name]["inFlight"] -= 1
+            self._cond.notify_all()
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "slotsInUse": self._in_use,
+                "totalSlots": self.total_slots,
+                "classes": {
+                    name: dict(self._stats[name], queueDepth=len(self._queues[name]))
+                    for name in self.by_priority
+                }
+            }
+
+
+admission = AdmissionController(TOTAL_WRITE_SLOTS, ROUTE_CLASSES)
+
+
+def route_class():
+    """
+    Map the current request to a route class, or None for unthrottled reads
+    """
+    if request.method not in ("POST", "PUT", "DELETE") or request.path.startswith("/admin/"):
+        return None
+    if request.path == "/processOrder":
+        return "sales"
+    if request.path.startswith("/product/batch"):
+        return "batch"
+    return "admin"
+
+
+@app.before_request
+def admit_request():
+    name = route_class()
+    if name is None:
+        return None
+
+    if not admission.acquire(name):
+        response = jsonify({"error": "Server busy, please retry shortly"})
+        response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+        return response, 503
+    g.admission_class = name
+
+
+@app.teardown_request
+def release_admission(error=None):
+    name = g.pop("admission_class", None)
+    if name is not None:
+        admission.release(name)
+
+
+@app.route("/admin/admission", methods=["GET"])
+def admission_metrics():
+    return jsonify(admission.metrics()), 200
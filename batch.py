@@ -1,18 +1,25 @@
 from product import app
 from flask import request, jsonify
 from datetime import date, datetime
+from tracing import span
+from response_cache import cached_response
 from db import (
-    get_db_connection,
     get_product_by_id,
     product_exists_by_id,
-    get_batches_by_product_id,
+    batch_expiry_exists,
+    get_batch_records_by_product_id,
     insert_batch,
     update_product_quantity,
     get_all_batches,
     get_batch_by_id,
-    update_batch_qty,
-    delete_batch
+    add_batch_qty,
+    delete_batch,
+    get_expiring_batches,
+    apply_batch_adjustments
 )
+from expiry_index import expiry_index, EXPIRY_INDEX_ENABLED
+
+MAX_PAGE_SIZE = 500
 
 @app.route("/product/batch/add/<int:product_id>", methods=["POST"])
 def add_batch(product_id):
@@ -38,17 +45,18 @@ def add_batch(product_id):
             return jsonify({"error": "Invalid expiry date format. Use YYYY-MM-DD"}), 400
 
         # Check if batch with same expiry date already exists
-        existing_batches = get_batches_by_product_id(product_id)
-        for batch in existing_batches:
-            if batch['expiry_date'] == expiry_date:
+        with span("batch.duplicate_check", product_id=product_id):
+            if batch_expiry_exists(product_id, expiry_date):
                 return jsonify({"error": "Batch with this expiry date already exists"}), 400
 
         # Insert batch into database
         created_at = updated_at = date.today()
-        batch_id = insert_batch(product_id, qty, expiry_date, created_at, updated_at)
+        with span("batch.insert", product_id=product_id):
+            batch_id = insert_batch(product_id, qty, expiry_date, created_at, updated_at)
 
         # Update product quantity by summing all batches
-        update_product_quantity(product_id)
+        with span("batch.update_product_qty", product_id=product_id):
+            update_product_quantity(product_id)
 
         # Respond with added batch details
         response = {
@@ -65,6 +73,7 @@ def add_batch(product_id):
         return jsonify({"error": str(e)}), 500
 
 @app.route("/product/batch", methods=["GET"])
+@cached_response("batch")
 def get_all_product_batches():
     try:
         batches = get_all_batches()
@@ -87,6 +96,45 @@ def get_all_product_batches():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
+@app.route("/product/batch/expiring", methods=["GET"])
+def get_expiring_product_batches():
+    try:
+        within_days = request.args.get("withinDays", type=int)
+        page = request.args.get("page", 1, type=int)
+        page_size = request.args.get("pageSize", 50, type=int)
+
+        if within_days is None or within_days < 0:
+            return jsonify({"error": "withinDays must be a non-negative integer"}), 400
+        if page < 1 or not 1 <= page_size <= MAX_PAGE_SIZE:
+            return jsonify({"error": f"page must be >= 1 and pageSize between 1 and {MAX_PAGE_SIZE}"}), 400
+
+        # Fetch one extra row to know whether another page follows
+        offset = (page - 1) * page_size
+        if EXPIRY_INDEX_ENABLED:
+            batches = expiry_index.expiring(within_days, page_size + 1, offset)
+        else:
+            batches = get_expiring_batches(within_days, page_size + 1, offset)
+
+        response = []
+        for batch in batches[:page_size]:
+            response.append({
+                "batchId": batch['batch_id'],
+                "productId": batch['product_id'],
+                "productName": batch['name'],
+                "price": float(batch['price']),
+                "qty": batch['qty'],
+                "expiryDate": str(batch['expiry_date'])
+            })
+        return jsonify({
+            "withinDays": within_days,
+            "page": page,
+            "pageSize": page_size,
+            "hasMore": len(batches) > page_size,
+            "batches": response
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/product/batchById/<int:batch_id>", methods=["GET"])
 def get_batch_details(batch_id): 
     try:
@@ -115,7 +163,6 @@ def update_batch(batch_id):
             return jsonify({"error": "Batch with given ID does not exist"}), 400
         
         product_id = batch['product_id']
-        old_qty = batch['qty']
         expiry_date = batch['expiry_date']
 
         today = date.today()
@@ -138,21 +185,24 @@ def update_batch(batch_id):
             return jsonify({"error": "Quantity must be greater than 0"}), 400
         
         # Step 4: Update batch quantity (add to existing)
-        updated_qty = old_qty + new_qty
-        update_batch_qty(batch_id, updated_qty)
+        with span("batch.update_qty", batch_id=batch_id):
+            updated_batch = add_batch_qty(batch_id, new_qty)
+        if not updated_batch:
+            return jsonify({"error": "Batch with given ID does not exist"}), 400
 
         # Step 5: Update product quantity
-        update_product_quantity(product_id)
+        with span("batch.update_product_qty", product_id=product_id):
+            update_product_quantity(product_id)
 
-        # Step 6: Build response
+        # Step 6: Build response from the committed row
 
         response = {
             "batchId": batch_id,
             "productId": product_id,
-            "qty": updated_qty,
-            "expiryDate": str(expiry_date),
-            "createdAt": str(batch['created_at']),
-            "updatedAt": str(date.today())
+            "qty": updated_batch['qty'],
+            "expiryDate": str(updated_batch['expiry_date']),
+            "createdAt": str(updated_batch['created_at']),
+            "updatedAt": str(updated_batch['updated_at'])
         }
 
         return jsonify(response), 200
@@ -160,6 +210,52 @@ def update_batch(batch_id):
         return jsonify({"error": str(e)}), 500  
     
 
+@app.route("/product/batch/adjust", methods=["PUT"])
+def adjust_batches():
+    try:
+        data = request.get_json()
+        adjustments = data.get("adjustments") if isinstance(data, dict) else None
+        if not adjustments or not isinstance(adjustments, list):
+            return jsonify({"error": "adjustments must be a non-empty list"}), 400
+
+        # Step 1: Validate lines, combining repeated batch IDs
+        deltas = {}
+        for line in adjustments:
+            batch_id = line.get("batchId") if isinstance(line, dict) else None
+            delta = line.get("delta") if isinstance(line, dict) else None
+            if (not isinstance(batch_id, int) or isinstance(batch_id, bool) or batch_id <= 0
+                    or not isinstance(delta, int) or isinstance(delta, bool)):
+                return jsonify({"error": f"Invalid adjustment {line}"}), 400
+            deltas[batch_id] = deltas.get(batch_id, 0) + delta
+
+        # Step 2: Lock the batches, delete expired ones and apply the rest in one transaction
+        with span("batch.apply_adjustments", batches=len(deltas)):
+            result = apply_batch_adjustments(deltas)
+        if result is None:
+            return jsonify({"error": "Batch quantities changed concurrently, please retry"}), 409
+        if "missing" in result:
+            return jsonify({"error": "Batches with given IDs do not exist", "batchIds": result["missing"]}), 400
+        if "negative" in result:
+            return jsonify({"error": "Adjustment would make batch quantity negative", "batchIds": result["negative"]}), 400
+
+        response = {
+            "adjusted": [
+                {
+                    "batchId": batch['batch_id'],
+                    "productId": batch['product_id'],
+                    "qty": batch['qty'],
+                    "expiryDate": str(batch['expiry_date'])
+                }
+                for batch in result["adjusted"]
+            ],
+            "expiredDeleted": result["expired"],
+            "productsUpdated": len(result["product_ids"])
+        }
+        return jsonify(response), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/product/batch/delete/<int:batch_id>", methods=["DELETE"])
 def delete_batch_route(batch_id):
     try:
@@ -191,17 +287,13 @@ def get_product_stock(product_id):
         if not product:
             return jsonify({"error": "Product not found"}), 404
 
-        batches = get_batches_by_product_id(product_id)
+        batches = get_batch_records_by_product_id(product_id)
 
         total_qty = 0
         batch_list = []
         for batch in batches:
-            batch_list.append({
-                "batchId": batch['batch_id'],
-                "quantity": batch['qty'],
-                "expiryDate": str(batch['expiry_date'])
-            })
-            total_qty += batch['qty']
+            batch_list.append(batch.to_stock_response())
+            total_qty += batch.qty
 
         alert_message = "Enough stock" if total_qty >= 10 else "Add stock"
         response = {
@@ -0,0 +1,47 @@
+"""
+Timing run for the bulk product import against the configured database.
+
+Imports N generated products (unique per run, with a share of in-file
+duplicates and invalid prices) through product_import.import_products and
+reports the elapsed time, rows per second and the summary counts. The
+products are left in place, so point DB_NAME at a scratch database.
+
+    DB_NAME=pharmacy_bench python bench_product_import.py --products 100000
+"""
+import argparse
+import time
+
+from db import ensure_schema
+from product_import import import_products
+
+
+def make_records(count, prefix):
+    for i in range(count):
+        if i % 50 == 49:
+            # Same name as the previous row with different case and spacing
+            yield {"name": f"  {prefix} PRODUCT  {i - 1} ", "price": "9.99"}
+        elif i % 100 == 0:
+            yield {"name": f"{prefix} product {i}", "price": "free"}
+        else:
+            yield {"name": f"{prefix} product {i}", "price": f"{1 + i % 500}.25"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a bulk product import")
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--prefix", default=f"bench-{int(time.time())}")
+    args = parser.parse_args()
+
+    ensure_schema()
+    start = time.perf_counter()
+    result = import_products(make_records(args.products, args.prefix), args.chunk_size)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.products} rows, chunk size {args.chunk_size}: {elapsed:.2f}s "
+          f"({args.products / elapsed:,.0f} rows/s)")
+    print(result["summary"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Memory/speed comparison of batch representations.
+
+Builds N synthetic batches as cursor-style dict rows and as BatchRecord
+objects (as held by expiry_index), and reports the memory held by each (tracemalloc) and the
+time to build it and to total the stock of one product.
+
+    python bench_stock_model.py --batches 1000000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from stock_model import BatchRecord
+
+
+def make_rows(count, products):
+    base = date.today()
+    for i in range(count):
+        # Each cursor row carries its own date objects, like mysql.connector returns
+        yield {
+            "batch_id": i + 1,
+            "product_id": i % products + 1,
+            "qty": i % 499,
+            "expiry_date": base + timedelta(days=i % 720),
+            "created_at": base - timedelta(days=i % 30),
+            "updated_at": base - timedelta(days=i % 30),
+            "version": 0
+        }
+
+
+def measure(label, build, total):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    data = build()
+    build_time = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    stock = total(data)
+    scan_time = time.perf_counter() - start
+
+    print(f"{label:<14} {size / 2**20:>9.1f} MiB  build {build_time:>6.2f}s  "
+          f"scan {scan_time * 1000:>8.1f}ms  (stock={stock})")
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare batch record representations")
+    parser.add_argument("--batches", type=int, default=1_000_000)
+    parser.add_argument("--products", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"{args.batches} batches, {args.products} products")
+
+    measure(
+        "dict rows",
+        lambda: list(make_rows(args.batches, args.products)),
+        lambda rows: sum(row["qty"] for row in rows if row["product_id"] == 1)
+    )
+    measure(
+        "BatchRecord",
+        lambda: [BatchRecord.from_row(row) for row in make_rows(args.batches, args.products)],
+        lambda records: sum(r.qty for r in records if r.product_id == 1)
+    )
+
+
+if __name__ == "__main__":
+    main()
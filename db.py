@@ -1,29 +1,254 @@
+import itertools
+import os
+import threading
+import time
+from datetime import date
+
 import mysql.connector
 
+from stock_model import BatchRecord
+from tracing import span, traced
+
+PRIMARY_DB_CONFIG = {
+    "host": os.environ.get("DB_HOST", "localhost"),
+    "user": os.environ.get("DB_USER", "root"),
+    "password": os.environ.get("DB_PASSWORD", ""),
+    "database": os.environ.get("DB_NAME", "pharmacy_db")
+}
+
+# Comma separated host[:port] list of read replicas, e.g. "replica1,replica2:3307".
+# Without replicas every read goes to the primary.
+REPLICA_DB_CONFIGS = []
+for _target in filter(None, os.environ.get("DB_REPLICA_HOSTS", "").split(",")):
+    _host, _, _port = _target.strip().partition(":")
+    REPLICA_DB_CONFIGS.append(dict(PRIMARY_DB_CONFIG, host=_host, port=int(_port or 3306)))
+
+# Seconds a replica that failed to connect is skipped before being tried again
+REPLICA_RETRY_AFTER = 30
+
+
+def _mysql_factory(config):
+    return lambda: mysql.connector.connect(**config)
+
+
+# Zero-argument callables returning new connections; see configure_connections
+_primary_factory = _mysql_factory(PRIMARY_DB_CONFIG)
+_replica_factories = [_mysql_factory(config) for config in REPLICA_DB_CONFIGS]
+_replica_cycle = itertools.cycle(range(len(_replica_factories)))
+_replica_down_until = {}
+_replica_lock = threading.Lock()
+_routing = threading.local()
+_write_listeners = {}
+
+
+def configure_connections(primary, replicas=()):
+    """
+    Replace the primary and replica connection factories. Each is a
+    zero-argument callable returning a DB-API connection that supports
+    cursor(dictionary=...) and %s placeholders like mysql.connector; tests use
+    fakes to exercise read routing without MySQL
+    """
+    global _primary_factory, _replica_factories, _replica_cycle
+    with _replica_lock:
+        _primary_factory = primary
+        _replica_factories = list(replicas)
+        _replica_cycle = itertools.cycle(range(len(_replica_factories)))
+        _replica_down_until.clear()
+
+
 def get_db_connection():
     """
-    Create and return MySQL connection
+    Create and return MySQL connection to the primary
+    """
+    return _primary_factory()
+
+
+def _mark_replica_down(index, error):
+    print("Replica unavailable, failing over:", index, error)
+    with _replica_lock:
+        _replica_down_until[index] = time.monotonic() + REPLICA_RETRY_AFTER
+
+
+def _connect_for_read():
+    """
+    Return (connection, replica index) for a read-only query, the index being
+    None for the primary.
+    Replicas are used round-robin, skipping ones that recently failed; once the
+    current request has written, reads stay on the primary (read-your-writes)
+    """
+    if not _replica_factories or getattr(_routing, "wrote", False):
+        return _primary_factory(), None
+
+    for _ in range(len(_replica_factories)):
+        with _replica_lock:
+            index = next(_replica_cycle)
+            if _replica_down_until.get(index, 0) > time.monotonic():
+                continue
+            connect = _replica_factories[index]
+        try:
+            return connect(), index
+        except Exception as e:
+            _mark_replica_down(index, e)
+
+    return _primary_factory(), None
+
+
+def _fetch(conn, query, params, one, dictionary):
+    try:
+        cursor = conn.cursor(dictionary=dictionary)
+        cursor.execute(query, params)
+        result = cursor.fetchone() if one else cursor.fetchall()
+        cursor.close()
+        return result
+    finally:
+        conn.close()
+
+
+def _read(query, params=(), one=False, dictionary=True):
+    """
+    Run a read-only query (routed by _connect_for_read) and return all rows,
+    or the first row when one=True. If the query fails on a replica, that
+    replica is marked down and the query is retried on the primary
+    """
+    conn, replica = _connect_for_read()
+    try:
+        return _fetch(conn, query, params, one, dictionary)
+    except Exception as e:
+        if replica is None:
+            raise
+        _mark_replica_down(replica, e)
+    return _fetch(_primary_factory(), query, params, one, dictionary)
+
+
+def reset_read_routing():
+    """
+    Forget writes made earlier on this thread; called at the start of each request
+    """
+    _routing.wrote = False
+
+
+def _mark_write(table, ids=None):
+    _routing.wrote = True
+    for callback in _write_listeners.get(table, ()):
+        callback(ids)
+
+
+def register_write_listener(table, callback):
+    """
+    Call callback(ids) after every committed write to the given table, e.g. to
+    update or invalidate in-process caches built from it. ids lists the
+    affected row IDs, or is None when they are not known.
+    "product_catalog" is reported in addition to "product" when a product's
+    name or price changes or it is deleted, but not for qty recomputes
+    """
+    _write_listeners.setdefault(table, []).append(callback)
+
+
+def _column_exists(cursor, table, column):
+    query = """
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    """
+    cursor.execute(query, (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+def _index_exists(cursor, table, index):
+    query = """
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+    """
+    cursor.execute(query, (table, index))
+    return cursor.fetchone()[0] > 0
+
+
+def _recompute_product_quantities(cursor, product_ids):
+    """
+    Set product.qty to the sum of its batches for the given products
+    """
+    if not product_ids:
+        return
+    placeholders = ", ".join(["%s"] * len(product_ids))
+    query = f"""
+        UPDATE product p
+        SET p.qty = (SELECT COALESCE(SUM(b.qty), 0) FROM batch b WHERE b.product_id = p.id),
+            p.updated_at = CURDATE()
+        WHERE p.id IN ({placeholders})
+    """
+    cursor.execute(query, list(product_ids))
+
+
+def _apply_ddl(cursor, statement):
+    try:
+        cursor.execute(statement)
+    except mysql.connector.errors.DatabaseError as e:
+        # Another worker starting at the same time added it first
+        if e.errno not in (1060, 1061):
+            raise
+
+
+def ensure_schema():
+    """
+    Apply the additive schema changes the application relies on
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Batch rows carry a version so stock deductions can be conditional
+    if not _column_exists(cursor, "batch", "version"):
+        _apply_ddl(cursor, "ALTER TABLE batch ADD COLUMN version INT NOT NULL DEFAULT 0")
+    # Date-range sales reports and exports
+    if not _index_exists(cursor, "sales", "idx_sales_sale_date"):
+        _apply_ddl(cursor, "CREATE INDEX idx_sales_sale_date ON sales (sale_date, sale_id)")
+    # Near-expiry stock lookups
+    if not _index_exists(cursor, "batch", "idx_batch_expiry_date"):
+        _apply_ddl(cursor, "CREATE INDEX idx_batch_expiry_date ON batch (expiry_date, batch_id)")
+    # Sales reports filtered by product
+    if not _index_exists(cursor, "sales_items", "idx_sales_items_product"):
+        _apply_ddl(cursor, "CREATE INDEX idx_sales_items_product ON sales_items (product_id, sale_id)")
+    # Duplicate-name checks compare product_name_key(name), stored on write
+    if not _column_exists(cursor, "product", "name_key"):
+        _apply_ddl(cursor, "ALTER TABLE product ADD COLUMN name_key VARCHAR(255) NULL")
+    cursor.execute("""
+        UPDATE product SET name_key = LOWER(TRIM(REGEXP_REPLACE(name, '[[:space:]]+', ' ')))
+        WHERE name_key IS NULL
+    """)
+    if not _index_exists(cursor, "product", "idx_product_name_key"):
+        _apply_ddl(cursor, "CREATE INDEX idx_product_name_key ON product (name_key)")
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def normalise_product_name(name):
+    """
+    Trim and collapse internal whitespace
+    """
+    return " ".join(name.split())
+
+
+def product_name_key(name):
+    """
+    Key two product names must not share: normalised and lowercased
     """
-    return mysql.connector.connect(
-        host="localhost",
-        user="root",
-        password="",
-        database="pharmacy_db"
-    )
+    return normalise_product_name(name).lower()
+
+
+@traced("db.product_exists")
 def product_exists(name):
     """
     Check if a product exists in the database
     """
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
-    query = "SELECT id FROM product WHERE LOWER(name) = LOWER(%s)"
-    cursor.execute(query, (name.strip(),))
+    query = "SELECT id FROM product WHERE name_key = %s"
+    cursor.execute(query, (product_name_key(name),))
     result = cursor.fetchone()
     cursor.close()
     conn.close()
 
     return result is not None
 
+@traced("db.product_exists_by_id")
 def product_exists_by_id(product_id):
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
@@ -35,16 +260,18 @@ def product_exists_by_id(product_id):
     return result is not None
 
 
+@traced("db.insert_product")
 def insert_product(name, price):
     """
     Insert a new product into the database
     """
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
-    query = "INSERT INTO product (name, price, qty, created_at, updated_at) VALUES (%s, %s, %s, CURDATE(), CURDATE())"
-    cursor.execute(query, (name, price, 0))
+    query = "INSERT INTO product (name, name_key, price, qty, created_at, updated_at) VALUES (%s, %s, %s, %s, CURDATE(), CURDATE())"
+    cursor.execute(query, (name, product_name_key(name), price, 0))
     conn.commit()
     product_id = cursor.lastrowid
+    _mark_write("product", [product_id])
 
     cursor.execute("SELECT * FROM product WHERE id = %s", (product_id,))
     product = cursor.fetchone()
@@ -53,42 +280,72 @@ def insert_product(name, price):
 
     return product
 
-def get_all_products():
+@traced("db.get_existing_product_names")
+def get_existing_product_names(names):
     """
-    Fetch all products from DB
+    Return the product_name_key() of each of names that already exists as a
+    product, using the same rule as product_exists
     """
+    if not names:
+        return set()
+    keys = {product_name_key(name) for name in names}
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    query = "SELECT * FROM product"
-    cursor.execute(query)
-    products = cursor.fetchall()
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(keys))
+    query = f"SELECT name_key FROM product WHERE name_key IN ({placeholders})"
+    cursor.execute(query, list(keys))
+    existing = {row[0] for row in cursor.fetchall()}
     cursor.close()
     conn.close()
 
-    return products
+    return existing
 
-def get_product_by_id(product_id):
+@traced("db.insert_products_bulk")
+def insert_products_bulk(products):
     """
-    Fetch a product by its ID
+    Insert many (name, price) products in one multi-row INSERT
     """
+    if not products:
+        return 0
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    query = "SELECT * FROM product WHERE id = %s"
-    cursor.execute(query, (product_id,))
-    product = cursor.fetchone()
+    cursor = conn.cursor()
+    query = "INSERT INTO product (name, name_key, price, qty, created_at, updated_at) VALUES (%s, %s, %s, 0, CURDATE(), CURDATE())"
+    cursor.executemany(query, [(name, product_name_key(name), price) for name, price in products])
+    conn.commit()
+    _mark_write("product")
+    inserted = cursor.rowcount
     cursor.close()
     conn.close()
 
+    return inserted
+
+@traced("db.get_all_products")
+def get_all_products():
+    """
+    Fetch all products from DB
+    """
+    products = _read("SELECT * FROM product")
+
+    return products
+
+@traced("db.get_product_by_id")
+def get_product_by_id(product_id):
+    """
+    Fetch a product by its ID
+    """
+    product = _read("SELECT * FROM product WHERE id = %s", (product_id,), one=True)
+
     return product  
 
+@traced("db.product_name_exists_by_id")
 def product_name_exists_by_id(name, product_id):
     """
     Check if a product name exists in the database excluding a specific product ID
     """
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
-    query = "SELECT id FROM product WHERE LOWER(name) = LOWER(%s) AND id != %s"
-    cursor.execute(query, (name.strip(), product_id))
+    query = "SELECT id FROM product WHERE name_key = %s AND id != %s"
+    cursor.execute(query, (product_name_key(name), product_id))
     result = cursor.fetchone()
     cursor.close()
     conn.close()
@@ -96,15 +353,18 @@ def product_name_exists_by_id(name, product_id):
     return result is not None
 
 
+@traced("db.update_product")
 def update_product(product_id, name, price):
     """
     Update product name and price, update updated_at only
     """
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
-    query = "UPDATE product SET name = %s, price = %s, updated_at = CURDATE() WHERE id = %s"
-    cursor.execute(query, (name, price, product_id))
+    query = "UPDATE product SET name = %s, name_key = %s, price = %s, updated_at = CURDATE() WHERE id = %s"
+    cursor.execute(query, (name, product_name_key(name), price, product_id))
     conn.commit()
+    _mark_write("product", [product_id])
+    _mark_write("product_catalog", [product_id])
 
     cursor.execute("SELECT * FROM product WHERE id = %s", (product_id,))
     product = cursor.fetchone()
@@ -113,6 +373,7 @@ def update_product(product_id, name, price):
 
     return product
 
+@traced("db.delete_product")
 def delete_product(product_id):
     """
     Delete a product by its ID
@@ -123,6 +384,9 @@ def delete_product(product_id):
         query = "DELETE FROM product WHERE id = %s"
         cursor.execute(query, (product_id,))
         conn.commit()
+        _mark_write("product", [product_id])
+        _mark_write("product_catalog", [product_id])
+        _mark_write("batch")
         affected_rows = cursor.rowcount
         cursor.close()
         conn.close()
@@ -135,19 +399,21 @@ def delete_product(product_id):
         return False
 
 # ----------------- BATCH RELATED FUNCTIONS -----------------
-def get_batches_by_product_id(product_id):
+@traced("db.batch_expiry_exists")
+def batch_expiry_exists(product_id, expiry_date):
     """
-    Fetch all batches for a given product_id
+    Check on the primary whether the product already has a batch with this expiry date
     """
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    query = "SELECT * FROM batch WHERE product_id = %s"
-    cursor.execute(query, (product_id,))
-    batches = cursor.fetchall()
+    cursor = conn.cursor()
+    query = "SELECT 1 FROM batch WHERE product_id = %s AND expiry_date = %s LIMIT 1"
+    cursor.execute(query, (product_id, expiry_date))
+    result = cursor.fetchone()
     cursor.close()
     conn.close()
-    return batches
+    return result is not None
 
+@traced("db.insert_batch")
 def insert_batch(product_id, qty, expiry_date, created_at, updated_at):
     """
     Insert a new batch for a product
@@ -161,42 +427,20 @@ def insert_batch(product_id, qty, expiry_date, created_at, updated_at):
     cursor.execute(query, (product_id, qty, expiry_date, created_at, updated_at))
     conn.commit()
     batch_id = cursor.lastrowid
+    _mark_write("batch", [batch_id])
     cursor.close()
     conn.close()
     return batch_id
 
-def update_product_quantity(product_id):
-    """
-    Update the quantity of the product by summing all its batches
-    """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # Sum qty from all batches for this product
-    query = "SELECT SUM(qty) as total_qty FROM batch WHERE product_id = %s"
-    cursor.execute(query, (product_id,))
-    result = cursor.fetchone()
-    total_qty = result[0] if result[0] is not None else 0
-
-    # Update product table
-    query_update = "UPDATE product SET qty = %s, updated_at = CURDATE() WHERE id = %s"
-    cursor.execute(query_update, (total_qty, product_id))
-    conn.commit()
-    cursor.close()
-    conn.close()
-
+@traced("db.get_all_batches")
 def get_all_batches():
     """
     Fetch all batches from the database
     """
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    query = "SELECT * FROM batch"
-    cursor.execute(query)
-    batches = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    batches = _read("SELECT * FROM batch")
     return batches 
 
+@traced("db.get_batch_by_id")
 def get_batch_by_id(batch_id):
     """
     Fetch a batch by its ID
@@ -210,19 +454,31 @@ def get_batch_by_id(batch_id):
     conn.close()
     return batch 
 
-def update_batch_qty(batch_id, new_qty):
+@traced("db.add_batch_qty")
+def add_batch_qty(batch_id, delta):
     """
-    Update the quantity of a batch
+    Add delta to a batch's quantity relative to its current value, so units
+    sold by orders committed meanwhile are not put back.
+    Returns the committed batch row, or None if the batch no longer exists
     """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    query = "UPDATE batch SET qty = %s, updated_at = CURDATE() WHERE batch_id = %s"
-    cursor.execute(query, (new_qty, batch_id))
+    cursor = conn.cursor(dictionary=True)
+    query = """
+        UPDATE batch
+        SET qty = qty + %s, version = version + 1, updated_at = CURDATE()
+        WHERE batch_id = %s
+    """
+    cursor.execute(query, (delta, batch_id))
+    cursor.execute("SELECT * FROM batch WHERE batch_id = %s", (batch_id,))
+    batch = cursor.fetchone()
     conn.commit()
+    _mark_write("batch", [batch_id])
     cursor.close()
-    conn.close()    
+    conn.close()
+    return batch
 
 
+@traced("db.delete_batch")
 def delete_batch(batch_id):
     """
     Delete a batch by its ID
@@ -233,6 +489,7 @@ def delete_batch(batch_id):
         query = "DELETE FROM batch WHERE batch_id = %s"
         cursor.execute(query, (batch_id,))
         conn.commit()
+        _mark_write("batch", [batch_id])
         affected_rows = cursor.rowcount
         cursor.close()
         conn.close()
@@ -244,90 +501,265 @@ def delete_batch(batch_id):
         print("Error deleting batch:", e)
         return False       
 
+def _select_batches_for_update(cursor, batch_ids, chunk_size):
+    rows = []
+    for start in range(0, len(batch_ids), chunk_size):
+        chunk = batch_ids[start:start + chunk_size]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(f"""
+            SELECT * FROM batch WHERE batch_id IN ({placeholders})
+            ORDER BY batch_id FOR UPDATE
+        """, chunk)
+        rows.extend(cursor.fetchall())
+    return rows
+
+@traced("db.apply_batch_adjustments")
+def apply_batch_adjustments(deltas, chunk_size=500):
+    """
+    Adjust batch quantities by deltas ({batch_id: delta}) in one transaction.
+    The batches are locked first; expired ones (expiry_date <= today) are
+    deleted instead of adjusted, and the qty of the touched products is
+    recomputed. Returns one of
+        {"missing": [batch_id, ...]}
+        {"negative": [batch_id, ...]}   an adjusted batch would go below 0
+        {"adjusted": [batch row, ...], "expired": [batch_id, ...], "product_ids": [...]}
+    with the committed rows, or None after losing a deadlock / lock wait
+    """
+    # Same batch_id order as order deductions, to keep lock order consistent
+    batch_ids = sorted(deltas)
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        conn.start_transaction()
+        batches = {row["batch_id"]: row for row in _select_batches_for_update(cursor, batch_ids, chunk_size)}
+
+        missing = [batch_id for batch_id in batch_ids if batch_id not in batches]
+        if missing:
+            conn.rollback()
+            return {"missing": missing}
+
+        today = date.today()
+        expired = [batch_id for batch_id in batch_ids if batches[batch_id]["expiry_date"] <= today]
+        items = [(batch_id, deltas[batch_id]) for batch_id in batch_ids
+                 if batches[batch_id]["expiry_date"] > today]
+
+        negative = [batch_id for batch_id, delta in items if batches[batch_id]["qty"] + delta < 0]
+        if negative:
+            conn.rollback()
+            return {"negative": negative}
+
+        if expired:
+            placeholders = ", ".join(["%s"] * len(expired))
+            cursor.execute(f"DELETE FROM batch WHERE batch_id IN ({placeholders})", expired)
+
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            rows = " UNION ALL ".join(
+                ["SELECT %s AS batch_id, %s AS delta"] + ["SELECT %s, %s"] * (len(chunk) - 1)
+            )
+            query = f"""
+                UPDATE batch b
+                JOIN ({rows}) d ON d.batch_id = b.batch_id
+                SET b.qty = b.qty + d.delta, b.version = b.version + 1, b.updated_at = CURDATE()
+            """
+            cursor.execute(query, [value for pair in chunk for value in pair])
+
+        product_ids = sorted({row["product_id"] for row in batches.values()})
+        _recompute_product_quantities(cursor, product_ids)
+
+        adjusted = _select_batches_for_update(cursor, [batch_id for batch_id, _ in items], chunk_size)
+        conn.commit()
+        _mark_write("batch", batch_ids)
+        _mark_write("product", product_ids)
+        return {"adjusted": adjusted, "expired": expired, "product_ids": product_ids}
+    except mysql.connector.errors.DatabaseError as e:
+        conn.rollback()
+        if e.errno in (1205, 1213):
+            return None
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
 
-# ----------------- SALE RELATED FUNCTIONS -----------------
-
-def get_batches_for_sale(product_id):
+@traced("db.get_expiring_batches")
+def get_expiring_batches(within_days, limit, offset=0):
     """
-    Fetch batches with qty > 0 for a given product_id, ordered by expiry_date ascending
+    Fetch batches with stock expiring between today and today + within_days,
+    joined with product name and price, ordered by expiry_date
     """
+    query = """
+        SELECT b.batch_id, b.product_id, b.qty, b.expiry_date, p.name, p.price
+        FROM batch b
+        JOIN product p ON p.id = b.product_id
+        WHERE b.expiry_date BETWEEN CURDATE() AND CURDATE() + INTERVAL %s DAY
+          AND b.qty > 0
+        ORDER BY b.expiry_date ASC, b.batch_id ASC
+        LIMIT %s OFFSET %s
+    """
+    return _read(query, (within_days, limit, offset))
+
+@traced("db.get_stocked_batches_with_product")
+def get_stocked_batches_with_product(batch_ids=None, product_ids=None):
+    """
+    Fetch batches with qty > 0 joined with product name and price, ordered by
+    expiry_date. When batch_ids and/or product_ids are given, only batches
+    matching either list are returned.
+    Reads from the primary, as it feeds in-process indexes
+    """
+    params = []
+    matches = []
+    for column, ids in (("b.batch_id", batch_ids), ("b.product_id", product_ids)):
+        if ids:
+            matches.append(f"{column} IN ({', '.join(['%s'] * len(ids))})")
+            params.extend(ids)
+    if batch_ids is not None or product_ids is not None:
+        if not matches:
+            return []
+        where = f"b.qty > 0 AND ({' OR '.join(matches)})"
+    else:
+        where = "b.qty > 0"
+
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
-    query = """
-        SELECT * FROM batch
-        WHERE product_id = %s AND qty > 0
-        ORDER BY expiry_date ASC
-    """
-    cursor.execute(query, (product_id,))
+    query = f"""
+        SELECT b.batch_id, b.product_id, b.qty, b.expiry_date, b.version, p.name, p.price, p.qty AS product_qty
+        FROM batch b
+        JOIN product p ON p.id = b.product_id
+        WHERE {where}
+        ORDER BY b.expiry_date ASC, b.batch_id ASC
+    """
+    cursor.execute(query, params)
     batches = cursor.fetchall()
     cursor.close()
     conn.close()
-    return batches  
+    return batches
+
+# ----------------- SALE RELATED FUNCTIONS -----------------
+
+def _batch_records(rows):
+    return [
+        BatchRecord(batch_id, product_id, qty, expiry_date.toordinal(), version)
+        for batch_id, product_id, qty, expiry_date, version in rows
+    ]
 
-def insert_sale(total_amount):
+@traced("db.get_batch_records_for_sale")
+def get_batch_records_for_sale(product_id):
     """
-    Insert a new sale record
+    Fetch batches with qty > 0 for a product as compact BatchRecord objects,
+    ordered by expiry_date ascending
     """
     conn = get_db_connection()
     cursor = conn.cursor()
     query = """
-        INSERT INTO sales (total_amount,sale_date,created_at)
-        VALUES (%s, CURDATE(), CURDATE())
+        SELECT batch_id, product_id, qty, expiry_date, version FROM batch
+        WHERE product_id = %s AND qty > 0
+        ORDER BY expiry_date ASC
     """
-    cursor.execute(query, (total_amount,))
-    conn.commit()
-    sale_id = cursor.lastrowid
+    cursor.execute(query, (product_id,))
+    batches = _batch_records(cursor.fetchall())
     cursor.close()
     conn.close()
-    return sale_id  
-
+    return batches
 
-def insert_sale_item(sale_id, product_id, unit_price, quantity, subtotal):
+@traced("db.get_batch_records_by_product_id")
+def get_batch_records_by_product_id(product_id):
     """
-    Insert a new sale item record
+    Fetch all batches for a product as compact BatchRecord objects
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     query = """
-        INSERT INTO sales_items (sale_id, product_id, unit_price, quantity, subtotal,created_at)
-        VALUES (%s, %s, %s, %s, %s, CURDATE())
+        SELECT batch_id, product_id, qty, expiry_date, version FROM batch
+        WHERE product_id = %s
     """
-    cursor.execute(query, (sale_id, product_id, unit_price, quantity, subtotal))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    return _batch_records(_read(query, (product_id,), dictionary=False))
 
-def update_batch_quantity(batch_id, new_qty):
+@traced("db.record_sale")
+def record_sale(total_amount, sale_lines, deductions):
     """
-    Update the quantity of a batch
+    Deduct stock, recompute product quantities and insert the sale with its
+    items in a single transaction.
+    Each batch update only applies while the batch still holds enough qty and
+    has the version seen during allocation; returns the new sale_id, or None
+    after rolling back on conflict
     """
     conn = get_db_connection()
     cursor = conn.cursor()
-    query = "UPDATE batch SET qty = %s, updated_at = CURDATE() WHERE batch_id = %s"
-    cursor.execute(query, (new_qty, batch_id))
-    conn.commit()
-    cursor.close()
-    conn.close()    
+    deduct_query = """
+        UPDATE batch
+        SET qty = qty - %s, version = version + 1, updated_at = CURDATE()
+        WHERE batch_id = %s AND qty >= %s AND version = %s
+    """
+    try:
+        conn.start_transaction()
+        # Lock rows in a stable order so concurrent orders cannot deadlock
+        with span("db.record_sale.deduct", deductions=len(deductions)):
+            for deduction in sorted(deductions, key=lambda d: d["batch_id"]):
+                cursor.execute(deduct_query, (
+                    deduction["deduct_qty"],
+                    deduction["batch_id"],
+                    deduction["deduct_qty"],
+                    deduction["version"]
+                ))
+                if cursor.rowcount != 1:
+                    conn.rollback()
+                    return None
+
+        product_ids = sorted({d["product_id"] for d in deductions})
+        with span("db.record_sale.recompute_products", products=len(product_ids)):
+            _recompute_product_quantities(cursor, product_ids)
+
+        with span("db.record_sale.insert_sale"):
+            cursor.execute("""
+                INSERT INTO sales (total_amount,sale_date,created_at)
+                VALUES (%s, CURDATE(), CURDATE())
+            """, (total_amount,))
+            sale_id = cursor.lastrowid
+
+        with span("db.record_sale.insert_items", items=len(sale_lines)):
+            cursor.executemany("""
+                INSERT INTO sales_items (sale_id, product_id, unit_price, quantity, subtotal,created_at)
+                VALUES (%s, %s, %s, %s, %s, CURDATE())
+            """, [
+                (sale_id, line["product_id"], line["unit_price"], line["quantity"], line["subtotal"])
+                for line in sale_lines
+            ])
+
+        conn.commit()
+        _mark_write("batch", [d["batch_id"] for d in deductions])
+        _mark_write("product", product_ids)
+        _mark_write("sales", [sale_id])
+        return sale_id
+    except mysql.connector.errors.DatabaseError as e:
+        conn.rollback()
+        # Deadlock / lock wait timeout are treated as a conflict and retried
+        if e.errno in (1205, 1213):
+            return None
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
 
+@traced("db.update_product_quantity")
 def update_product_quantity(product_id):
     """
     Recalculate total product quantity from batches
     """
     conn = get_db_connection()
     cursor = conn.cursor()
-    # Sum qty from all batches for this product
-    query = "SELECT SUM(qty) as total_qty FROM batch WHERE product_id = %s"
-    cursor.execute(query, (product_id,))
-    result = cursor.fetchone()
-    total_qty = result[0] if result[0] is not None else 0
-
-    # Update product table
-    query_update = "UPDATE product SET qty = %s, updated_at = CURDATE() WHERE id = %s"
-    cursor.execute(query_update, (total_qty, product_id))
+    # Sum and update in one statement so concurrent recomputes cannot
+    # overwrite each other with stale totals
+    _recompute_product_quantities(cursor, [product_id])
     conn.commit()
+    _mark_write("product", [product_id])
     cursor.close()
-    conn.close( )
+    conn.close()
 
+@traced("db.get_product_price")
 def get_product_price(product_id):
     """
     Fetch the price of a product by its ID
@@ -342,33 +774,100 @@ def get_product_price(product_id):
     return product[0] if product else None
 
 
-def get_all_sales():
+def _sales_filter(from_date=None, to_date=None, product_id=None):
     """
-    Fetch all sales records
+    Build the WHERE clause and params shared by sales listing and export
     """
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    conditions = []
+    params = []
+    if from_date is not None:
+        conditions.append("s.sale_date >= %s")
+        params.append(from_date)
+    if to_date is not None:
+        conditions.append("s.sale_date <= %s")
+        params.append(to_date)
+    if product_id is not None:
+        conditions.append("""
+            EXISTS (SELECT 1 FROM sales_items si
+                    WHERE si.sale_id = s.sale_id AND si.product_id = %s)
+        """)
+        params.append(product_id)
 
-    query = """
-        SELECT sale_id, sale_date, total_amount, created_at
-        FROM sales
-        ORDER BY sale_id ASC
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, params
+
+
+@traced("db.get_all_sales")
+def get_all_sales(from_date=None, to_date=None, product_id=None):
+    """
+    Fetch sales records, optionally limited to a sale_date range and to sales
+    containing a given product
+    """
+    where, params = _sales_filter(from_date, to_date, product_id)
+    query = f"""
+        SELECT s.sale_id, s.sale_date, s.total_amount, s.created_at
+        FROM sales s
+        {where}
+        ORDER BY s.sale_id ASC
     """
-    cursor.execute(query)
-    sales = cursor.fetchall()
+    return _read(query, params)
 
-    cursor.close()
-    conn.close()
-    return sales
+
+def iter_sales_export(from_date=None, to_date=None, product_id=None, fetch_size=500):
+    """
+    Yield sales joined with their items one row at a time.
+    Uses an unbuffered cursor so rows are streamed from the server instead of
+    being loaded into memory
+    """
+    where, params = _sales_filter(from_date, to_date)
+    if product_id is not None:
+        # Export only the matching item lines, not whole sales
+        where = (where + " AND" if where else "WHERE") + " si.product_id = %s"
+        params.append(product_id)
+    query = f"""
+        SELECT
+            s.sale_id, s.sale_date, s.total_amount,
+            si.sale_item_id, si.product_id, si.quantity, si.unit_price, si.subtotal
+        FROM sales s
+        JOIN sales_items si ON si.sale_id = s.sale_id
+        {where}
+        ORDER BY s.sale_date ASC, s.sale_id ASC, si.sale_item_id ASC
+    """
+    conn, replica = _connect_for_read()
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(query, params)
+    except Exception as e:
+        conn.close()
+        if replica is None:
+            raise
+        # Rows cannot be replayed once streaming starts, so only the initial
+        # query fails over to the primary
+        _mark_replica_down(replica, e)
+        conn = _primary_factory()
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        cursor.execute(query, params)
+
+    try:
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        try:
+            cursor.close()
+        except mysql.connector.Error:
+            # Export abandoned mid-stream; closing the connection discards the rest
+            pass
+        conn.close()
 
 
+@traced("db.get_sale_items_by_sale_id")
 def get_sale_items_by_sale_id(sale_id):
     """
     Fetch all sale items for a given sale_id
     """
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-
     query = """
         SELECT
             sale_item_id,
@@ -382,9 +881,4 @@ def get_sale_items_by_sale_id(sale_id):
         WHERE sale_id = %s
         ORDER BY sale_item_id ASC
     """
-    cursor.execute(query, (sale_id,))
-    items = cursor.fetchall()
-
-    cursor.close()
-    conn.close()
-    return items
+    return _read(query, (sale_id,))
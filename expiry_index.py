@@ -0,0 +1,170 @@
+"""
+In-process index of stocked batches sorted by expiry date.
+
+Enabled with EXPIRY_INDEX_ENABLED=1. The index is loaded from the primary on
+first use and then kept current incrementally: write listeners only record
+the touched batch and product IDs, and the next lookup re-reads those batches
+(and the batches of renamed/repriced products) in one query and replaces
+their entries. A near-expiry query is two bisects and a slice of the matching
+entries.
+
+Entries are BatchRecord objects keyed by (expiry_day, batch_id), with one
+ProductRecord per product for the name and price, so a large index does not
+hold a dict and date objects per batch.
+
+Only writes made by this process are seen; writes from other processes show
+up after the next full load (on restart, or after a write whose rows are not
+known).
+"""
+import bisect
+import os
+import threading
+from datetime import date
+
+from db import get_stocked_batches_with_product, register_write_listener
+from stock_model import BatchRecord, ProductRecord, to_day
+
+EXPIRY_INDEX_ENABLED = os.environ.get("EXPIRY_INDEX_ENABLED", "0") == "1"
+
+
+class ExpiryIndex:
+    def __init__(self, loader):
+        self._loader = loader
+        # _lock guards the state below and is never held while querying;
+        # _refresh_lock keeps one refresh query in flight at a time
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._keys = []
+        self._records = []
+        self._by_batch = {}
+        self._by_product = {}
+        self._products = {}
+        self._dirty_batches = set()
+        self._dirty_products = set()
+        self._active = False
+        self._loaded = False
+
+    @staticmethod
+    def _product(row):
+        return ProductRecord(row["product_id"], row["name"], row["price"], row["product_qty"])
+
+    def _remove(self, batch_id):
+        record = self._by_batch.pop(batch_id, None)
+        if record is not None:
+            index = bisect.bisect_left(self._keys, (record.expiry_day, batch_id))
+            del self._keys[index]
+            del self._records[index]
+            batch_ids = self._by_product[record.product_id]
+            batch_ids.discard(batch_id)
+            if not batch_ids:
+                del self._by_product[record.product_id]
+                del self._products[record.product_id]
+
+    def _insert(self, row):
+        self._remove(row["batch_id"])
+        record = BatchRecord.from_row(row)
+        key = (record.expiry_day, record.batch_id)
+        index = bisect.bisect_left(self._keys, key)
+        self._keys.insert(index, key)
+        self._records.insert(index, record)
+        self._by_batch[record.batch_id] = record
+        self._by_product.setdefault(record.product_id, set()).add(record.batch_id)
+        self._products[record.product_id] = self._product(row)
+
+    def _to_row(self, record):
+        product = self._products[record.product_id]
+        return {
+            "batch_id": record.batch_id,
+            "product_id": record.product_id,
+            "qty": record.qty,
+            "expiry_date": record.expiry_date,
+            "name": product.name,
+            "price": product.price
+        }
+
+    def batches_written(self, batch_ids):
+        """
+        Mark the given batches for re-reading on the next lookup
+        """
+        with self._lock:
+            if not self._active:
+                return
+            if batch_ids is None:
+                self._loaded = False
+            else:
+                self._dirty_batches.update(batch_ids)
+
+    def products_written(self, product_ids):
+        """
+        Mark the batches of products whose name or price changed for re-reading
+        """
+        with self._lock:
+            if not self._active:
+                return
+            if product_ids is None:
+                self._loaded = False
+            else:
+                self._dirty_products.update(product_ids)
+
+    def _refresh(self):
+        with self._refresh_lock:
+            with self._lock:
+                self._active = True
+                full = not self._loaded
+                batch_ids, product_ids = self._dirty_batches, self._dirty_products
+                # Writes committed from here on are picked up by the next refresh
+                self._dirty_batches, self._dirty_products = set(), set()
+                self._loaded = True
+            if not full and not batch_ids and not product_ids:
+                return
+
+            try:
+                if full:
+                    rows = self._loader()
+                else:
+                    rows = self._loader(batch_ids=list(batch_ids), product_ids=list(product_ids))
+            except Exception:
+                with self._lock:
+                    if full:
+                        self._loaded = False
+                    else:
+                        self._dirty_batches |= batch_ids
+                        self._dirty_products |= product_ids
+                raise
+
+            with self._lock:
+                if full:
+                    # Rows arrive ordered by (expiry_date, batch_id)
+                    self._records = [BatchRecord.from_row(row) for row in rows]
+                    self._keys = [(record.expiry_day, record.batch_id) for record in self._records]
+                    self._by_batch = {record.batch_id: record for record in self._records}
+                    self._by_product, self._products = {}, {}
+                    for row in rows:
+                        self._by_product.setdefault(row["product_id"], set()).add(row["batch_id"])
+                        if row["product_id"] not in self._products:
+                            self._products[row["product_id"]] = self._product(row)
+                    return
+                for product_id in product_ids:
+                    batch_ids |= self._by_product.get(product_id, set())
+                for batch_id in batch_ids:
+                    self._remove(batch_id)
+                for row in rows:
+                    self._insert(row)
+
+    def expiring(self, within_days, limit, offset=0):
+        """
+        Return up to limit batches expiring between today and today + within_days
+        """
+        self._refresh()
+        today = to_day(date.today())
+        with self._lock:
+            start = bisect.bisect_left(self._keys, (today,))
+            end = bisect.bisect_left(self._keys, (today + within_days + 1,))
+            start = min(start + offset, end)
+            return [self._to_row(record) for record in self._records[start:min(start + limit, end)]]
+
+
+expiry_index = ExpiryIndex(get_stocked_batches_with_product)
+if EXPIRY_INDEX_ENABLED:
+    register_write_listener("batch", expiry_index.batches_written)
+    register_write_listener("product_catalog", expiry_index.products_written)
@@ -0,0 +1,288 @@
+"""
+Concurrent order load test for the pharmacy API.
+
+For each concurrency level, seeds a fresh set of products and batches through
+the HTTP API with enough stock for the mix's worst case, fires the order mix
+and prints throughput/latency, for all responses and for 200s only. Then it
+checks the stock and sales invariants directly in the database.
+
+    python loadtest.py --base-url http://localhost:5000 --mix hot --concurrency 1,8,32
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from db import get_db_connection
+
+MIXES = ("hot", "basket", "mixed")
+# Most units one request of each mix can take from a single product
+MAX_UNITS_PER_REQUEST = {"hot": 3, "basket": 2, "mixed": 1}
+
+
+def call(base_url, method, path, payload=None, timeout=30):
+    """
+    Send a request and return (status, parsed body, elapsed seconds)
+    """
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method)
+    if data is not None:
+        req.add_header("Content-Type", "application/json")
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            status, body = resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        status, body = e.code, e.read()
+    except (urllib.error.URLError, TimeoutError) as e:
+        return 0, {"error": str(e)}, time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+
+    try:
+        body = json.loads(body) if body else None
+    except ValueError:
+        body = None
+    return status, body, elapsed
+
+
+# ----------------- SEEDING -----------------
+
+def seed(base_url, prefix, products, batches_per_product, batch_qty):
+    """
+    Create products with batches and return {product_id: seeded qty}
+    """
+    seeded = {}
+    for n in range(products):
+        status, body, _ = call(base_url, "POST", "/product/add", {
+            "name": f"{prefix}-{n}",
+            "price": round(random.uniform(1, 50), 2)
+        })
+        if status != 201:
+            raise SystemExit(f"Seeding product failed ({status}): {body}")
+        product_id = body["id"]
+
+        for b in range(batches_per_product):
+            expiry = date.today() + timedelta(days=30 + b * 30)
+            status, body, _ = call(base_url, "POST", f"/product/batch/add/{product_id}", {
+                "qty": batch_qty,
+                "expiryDate": expiry.strftime("%Y-%m-%d")
+            })
+            if status != 201:
+                raise SystemExit(f"Seeding batch failed ({status}): {body}")
+        seeded[product_id] = batches_per_product * batch_qty
+    return seeded
+
+
+# ----------------- WORKLOAD -----------------
+
+def next_request(mix, product_ids):
+    """
+    Pick the next (method, path, payload) for the given mix
+    """
+    if mix == "hot":
+        # Every order competes for the same SKU
+        return "POST", "/processOrder", {
+            "saleItems": [{"productId": product_ids[0], "quantity": random.randint(1, 3)}]
+        }
+
+    if mix == "basket":
+        lines = random.sample(product_ids, min(len(product_ids), random.randint(10, 25)))
+        return "POST", "/processOrder", {
+            "saleItems": [{"productId": p, "quantity": random.randint(1, 2)} for p in lines]
+        }
+
+    # mixed: mostly small orders, the rest dashboard-style reads
+    if random.random() < 0.7:
+        lines = random.sample(product_ids, min(len(product_ids), random.randint(1, 3)))
+        return "POST", "/processOrder", {
+            "saleItems": [{"productId": p, "quantity": 1} for p in lines]
+        }
+    path = random.choice([
+        "/product",
+        "/product/batch",
+        "/allSales",
+        f"/product/stock/{random.choice(product_ids)}"
+    ])
+    return "GET", path, None
+
+
+def run_level(base_url, mix, product_ids, concurrency, total_requests):
+    """
+    Run total_requests at the given concurrency and summarise the results
+    """
+    latencies = []
+    ok_latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(_):
+        method, path, payload = next_request(mix, product_ids)
+        status, _, elapsed = call(base_url, method, path, payload)
+        with lock:
+            latencies.append(elapsed)
+            if status == 200:
+                ok_latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(total_requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "throughput": round(total_requests / wall, 2),
+        "latency": summarise(latencies),
+        "okRequests": len(ok_latencies),
+        "okThroughput": round(len(ok_latencies) / wall, 2),
+        "okLatency": summarise(ok_latencies),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())}
+    }
+
+
+def summarise(latencies):
+    """
+    Mean and percentile latencies in ms, or None without samples
+    """
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2)
+
+    return {
+        "meanMs": round(statistics.mean(latencies) * 1000, 2),
+        "p50Ms": pct(0.50),
+        "p95Ms": pct(0.95),
+        "p99Ms": pct(0.99),
+        "maxMs": round(latencies[-1] * 1000, 2)
+    }
+
+
+# ----------------- INVARIANTS -----------------
+
+def check_invariants(seeded):
+    """
+    Verify stock and sales consistency after the run.
+    Returns a list of violation messages (empty when consistent)
+    """
+    violations = []
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+
+    cursor.execute("SELECT batch_id, qty FROM batch WHERE qty < 0")
+    for row in cursor.fetchall():
+        violations.append(f"Batch {row['batch_id']} has negative qty {row['qty']}")
+
+    cursor.execute("""
+        SELECT p.id, p.qty, COALESCE(SUM(b.qty), 0) AS batch_total
+        FROM product p
+        LEFT JOIN batch b ON b.product_id = p.id
+        GROUP BY p.id, p.qty
+        HAVING p.qty <> batch_total
+    """)
+    for row in cursor.fetchall():
+        violations.append(
+            f"Product {row['id']} qty {row['qty']} != sum of batches {row['batch_total']}"
+        )
+
+    cursor.execute("""
+        SELECT s.sale_id, s.total_amount, COALESCE(SUM(si.subtotal), 0) AS items_total
+        FROM sales s
+        LEFT JOIN sales_items si ON si.sale_id = s.sale_id
+        GROUP BY s.sale_id, s.total_amount
+        HAVING ABS(s.total_amount - items_total) > 0.01
+    """)
+    for row in cursor.fetchall():
+        violations.append(
+            f"Sale {row['sale_id']} total {row['total_amount']} != sum of items {row['items_total']}"
+        )
+
+    # Units sold must match units removed from the seeded batches (no oversell)
+    product_ids = list(seeded)
+    placeholders = ", ".join(["%s"] * len(product_ids))
+    cursor.execute(f"""
+        SELECT p.id,
+               (SELECT COALESCE(SUM(qty), 0) FROM batch WHERE product_id = p.id) AS remaining,
+               (SELECT COALESCE(SUM(quantity), 0) FROM sales_items WHERE product_id = p.id) AS sold
+        FROM product p
+        WHERE p.id IN ({placeholders})
+    """, product_ids)
+    for row in cursor.fetchall():
+        if row["remaining"] + row["sold"] != seeded[row["id"]]:
+            violations.append(
+                f"Product {row['id']}: sold {row['sold']} + remaining {row['remaining']} "
+                f"!= seeded {seeded[row['id']]}"
+            )
+
+    cursor.close()
+    conn.close()
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent order load test")
+    parser.add_argument("--base-url", default="http://localhost:5000")
+    parser.add_argument("--mix", choices=MIXES, default="mixed")
+    parser.add_argument("--products", type=int, default=30)
+    parser.add_argument("--batches-per-product", type=int, default=3)
+    parser.add_argument("--batch-qty", type=int,
+                        help="qty per seeded batch; by default sized so no level runs out of stock")
+    parser.add_argument("--concurrency", default="1,4,16,32",
+                        help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=500,
+                        help="requests per concurrency level")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    batch_qty = args.batch_qty
+    if batch_qty is None:
+        demand = MAX_UNITS_PER_REQUEST[args.mix] * args.requests
+        batch_qty = -(-demand // args.batches_per_product)
+
+    run_id = int(time.time())
+    seeded = {}
+    results = []
+    for level in (int(c) for c in args.concurrency.split(",")):
+        # Fresh stock per level so earlier levels cannot drain later ones
+        level_seeded = seed(args.base_url, f"LT-{run_id}-c{level}", args.products,
+                            args.batches_per_product, batch_qty)
+        seeded.update(level_seeded)
+        result = run_level(args.base_url, args.mix, list(level_seeded), level, args.requests)
+        results.append(result)
+        latency, ok_latency = result["latency"], result["okLatency"] or {}
+        print(
+            f"c={result['concurrency']:<4} {result['throughput']:>8} req/s  "
+            f"p50={latency['p50Ms']}ms p95={latency['p95Ms']}ms p99={latency['p99Ms']}ms  "
+            f"statuses={result['statuses']}"
+        )
+        print(
+            f"{'':<7}{result['okThroughput']:>8} ok/s   "
+            f"p50={ok_latency.get('p50Ms')}ms p95={ok_latency.get('p95Ms')}ms "
+            f"p99={ok_latency.get('p99Ms')}ms  (200 responses only)"
+        )
+
+    violations = check_invariants(seeded)
+    for violation in violations:
+        print("VIOLATION:", violation)
+    print("Invariants OK" if not violations else f"{len(violations)} invariant violations")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"mix": args.mix, "batchQty": batch_qty, "levels": results,
+                       "violations": violations}, f, indent=2)
+
+    raise SystemExit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
 from product import app
+from db import ensure_schema
 import batch
 import order
+import admin
+import admission
+
+# Applied on import so every way of serving `app` (python main.py, flask run,
+# gunicorn main:app) has the columns and indexes the routes rely on
+ensure_schema()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000,debug=True) 
 
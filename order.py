@@ -1,19 +1,69 @@
 from product import app
-from flask import request, jsonify
+from flask import request, jsonify, Response
 from datetime import date, datetime
+import csv
+import io
+import random
+import threading
+import time
+from stock_model import allocate_fifo
+from tracing import span
 from db import (
     get_product_by_id,
-    get_batches_for_sale,
-    update_batch_quantity,
-    update_product_quantity,
-    insert_sale,
-    insert_sale_item,
+    get_batch_records_for_sale,
+    record_sale,
     get_product_price,
     get_all_sales,
-    get_sale_items_by_sale_id
+    get_sale_items_by_sale_id,
+    iter_sales_export
     
 )
 
+# Number of times an order re-reads stock and re-allocates after a conflicting
+# concurrent deduction before giving up
+MAX_ALLOCATION_ATTEMPTS = 5
+
+allocation_metrics = {
+    "orders": 0,
+    "conflicts": 0,
+    "retries": 0,
+    "exhausted": 0
+}
+_metrics_lock = threading.Lock()
+
+
+def _record_metric(name):
+    with _metrics_lock:
+        allocation_metrics[name] += 1
+
+
+def _allocate_stock(sale_items):
+    """
+    Allocate requested quantities to batches, earliest expiry first.
+    Returns (deductions, None) or (None, product_id) when stock is short
+    """
+    # Lines for the same product draw from the same batches, so allocate their
+    # combined quantity once
+    quantities = {}
+    for item in sale_items:
+        quantities[item["productId"]] = quantities.get(item["productId"], 0) + item["quantity"]
+
+    deductions = []
+    for product_id, qty_to_allocate in quantities.items():
+        allocations = allocate_fifo(get_batch_records_for_sale(product_id), qty_to_allocate)
+        if allocations is None:
+            return None, product_id
+
+        for batch, deduct_qty in allocations:
+            deductions.append({
+                "batch_id": batch.batch_id,
+                "product_id": product_id,
+                "deduct_qty": deduct_qty,
+                "version": batch.version
+            })
+    return deductions, None
+
+
 @app.route('/processOrder', methods=['POST'])
 def process_order():
     try:
@@ -23,68 +73,59 @@ def process_order():
             return jsonify({"error": "Invalid saleItems"}), 400
 
         total_amount = 0
-        sale_deductions = []
+        unit_prices = {}
 
-        # First, validate stock and calculate totals
-        for item in sale_items:
-            product_id = item.get("productId")
-            quantity_needed = item.get("quantity")
-
-            if not product_id or not isinstance(quantity_needed, int) or quantity_needed <= 0:
-                return jsonify({"error": f"Invalid data for product {product_id}"}), 400
-
-            product = get_product_by_id(product_id)
-            if not product:
-                return jsonify({"error": f"Product ID {product_id} not found"}), 404
-            
-            batches = get_batches_for_sale(product_id)
-            stock_available = sum(batch["qty"] for batch in batches)
-            if stock_available < quantity_needed:
-                return jsonify({"error": f"Insufficient stock for product {product_id}"}), 400
-            
-            qty_to_allocate = quantity_needed
-
-            for batch in batches:
-                if batch["qty"] >= qty_to_allocate:
-                    sale_deductions.append({
-                        "batch_id": batch["batch_id"],
-                        "product_id": product_id,
-                        "deduct_qty": qty_to_allocate
-                    })
-                    qty_to_allocate = 0
-                    break
-                else:
-                    sale_deductions.append({
-                        "batch_id": batch["batch_id"],
-                        "product_id": product_id,
-                        "deduct_qty": batch["qty"]
-                    })
-                    qty_to_allocate -= batch["qty"]
-            # Step 3: Calculate total amount
-            unit_price = get_product_price(product_id)
-            total_amount += unit_price * quantity_needed
-        # Step 4: Insert sale
-        sale_id = insert_sale(total_amount)
-        # Step 5: Deduct stock from batches and create sale items
+        # Step 1: Validate items and calculate totals
+        with span("order.validate", items=len(sale_items)):
+            for item in sale_items:
+                product_id = item.get("productId")
+                quantity_needed = item.get("quantity")
+
+                if not product_id or not isinstance(quantity_needed, int) or quantity_needed <= 0:
+                    return jsonify({"error": f"Invalid data for product {product_id}"}), 400
+
+                product = get_product_by_id(product_id)
+                if not product:
+                    return jsonify({"error": f"Product ID {product_id} not found"}), 404
+
+                if product_id not in unit_prices:
+                    unit_prices[product_id] = get_product_price(product_id)
+                total_amount += unit_prices[product_id] * quantity_needed
+
+        sale_lines = []
         for item in sale_items:
-            product_id = item["productId"]
-            quantity_needed = item["quantity"]
-            unit_price = get_product_price(product_id)
-            subtotal = unit_price * quantity_needed
-
-            # Insert sale item
-            insert_sale_item(sale_id, product_id, quantity_needed, unit_price, subtotal)
-
-        # Step 6: Deduct stock from batches
-        
-        for deduction in sale_deductions:
-            batch = get_batches_for_sale(deduction["product_id"])
-            for b in batch:
-                if b["batch_id"] == deduction["batch_id"]:
-                    new_qty = b["qty"] - deduction["deduct_qty"]
-                    update_batch_quantity(deduction["batch_id"], new_qty)
-                    update_product_quantity(deduction["product_id"])
-                    break
+            unit_price = unit_prices[item["productId"]]
+            sale_lines.append({
+                "product_id": item["productId"],
+                "unit_price": unit_price,
+                "quantity": item["quantity"],
+                "subtotal": unit_price * item["quantity"]
+            })
+
+        # Step 2: Allocate stock, then deduct it with conditional updates and
+        # record the sale in one transaction, re-allocating if another order
+        # changed the same batches meanwhile
+        _record_metric("orders")
+        for attempt in range(MAX_ALLOCATION_ATTEMPTS):
+            if attempt > 0:
+                _record_metric("retries")
+                time.sleep(random.uniform(0, 0.005 * attempt))
+
+            with span("order.allocate", attempt=attempt):
+                sale_deductions, short_product_id = _allocate_stock(sale_items)
+            if sale_deductions is None:
+                return jsonify({"error": f"Insufficient stock for product {short_product_id}"}), 400
+
+            with span("order.record_sale", attempt=attempt, batches=len(sale_deductions),
+                      items=len(sale_lines)) as sale_span:
+                sale_id = record_sale(total_amount, sale_lines, sale_deductions)
+                sale_span.set_attribute("conflict", sale_id is None)
+            if sale_id is not None:
+                break
+            _record_metric("conflicts")
+        else:
+            _record_metric("exhausted")
+            return jsonify({"error": "Stock changed concurrently, please retry the order"}), 409
 
         return jsonify({
             "saleId": sale_id,
@@ -97,10 +138,47 @@ def process_order():
         return jsonify({"error": str(e)}), 500
     
 
+@app.route('/processOrder/metrics', methods=['GET'])
+def process_order_metrics():
+    with _metrics_lock:
+        return jsonify(dict(allocation_metrics)), 200
+
+
+def _parse_sales_filters():
+    """
+    Read from/to (YYYY-MM-DD) and productId query parameters.
+    Returns (filters, None) or (None, error message)
+    """
+    filters = {}
+    for param, key in (("from", "from_date"), ("to", "to_date")):
+        value = request.args.get(param)
+        if value:
+            try:
+                filters[key] = datetime.strptime(value, "%Y-%m-%d").date()
+            except ValueError:
+                return None, f"Invalid '{param}' date format. Use YYYY-MM-DD"
+
+    if "from_date" in filters and "to_date" in filters and filters["from_date"] > filters["to_date"]:
+        return None, "'from' date must not be after 'to' date"
+
+    product_id = request.args.get("productId")
+    if product_id:
+        # isdigit() alone would let 0 and non-ASCII digits through
+        if not (product_id.isascii() and product_id.isdigit()) or int(product_id) <= 0:
+            return None, "productId must be a positive integer"
+        filters["product_id"] = int(product_id)
+
+    return filters, None
+
+
 @app.route('/allSales', methods=['GET'])
 def all_sales():
     try:
-        sales = get_all_sales()
+        filters, error = _parse_sales_filters()
+        if error:
+            return jsonify({"error": error}), 400
+
+        sales = get_all_sales(**filters)
 
         if not sales:
             return jsonify({"message": "No sales records found"}), 200
@@ -146,3 +224,43 @@ def get_sale_items(sale_id):
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+
+@app.route('/sales/export', methods=['GET'])
+def export_sales():
+    filters, error = _parse_sales_filters()
+    if error:
+        return jsonify({"error": error}), 400
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def flush():
+            line = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            return line
+
+        writer.writerow([
+            "saleId", "saleDate", "totalAmount", "saleItemId",
+            "productId", "quantity", "unitPrice", "subtotal"
+        ])
+        yield flush()
+
+        for row in iter_sales_export(**filters):
+            writer.writerow([
+                row["sale_id"],
+                row["sale_date"].strftime("%Y-%m-%d"),
+                row["total_amount"],
+                row["sale_item_id"],
+                row["product_id"],
+                row["quantity"],
+                row["unit_price"],
+                row["subtotal"]
+            ])
+            yield flush()
+
+    return Response(generate(), mimetype="text/csv", headers={
+        "Content-Disposition": "attachment; filename=sales_export.csv"
+    })
@@ -1,7 +1,17 @@
 from flask import Flask, request,jsonify
-from db import product_exists, insert_product,get_all_products,get_product_by_id,update_product,product_name_exists_by_id,delete_product
+import io
+from db import reset_read_routing, product_exists, insert_product,get_all_products,get_product_by_id,update_product,product_name_exists_by_id,delete_product
+from product_import import import_products, iter_records
+from response_cache import cached_response, compress_response
 
 app = Flask(__name__)
+app.after_request(compress_response)
+
+
+@app.before_request
+def reset_db_routing():
+    # Each request starts reading from replicas until it writes
+    reset_read_routing()
 
 @app.route("/product/add",methods=["POST"] )
 def add_product():
@@ -37,9 +47,38 @@ def add_product():
         "updatedAt": product["updated_at"].isoformat()
     }), 201
 
+# ----------------- Bulk Import Products -----------------
+
+@app.route("/product/import", methods=["POST"])
+def import_products_api():
+    # Only touch request.files for multipart uploads; for any other body it
+    # would read the whole stream into memory before the import starts
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        if upload is None:
+            return jsonify({"error": "Multipart upload must include a file part"}), 400
+        stream, filename = upload.stream, upload.filename or ""
+    else:
+        stream, filename = request.stream, ""
+
+    fmt = request.args.get("format")
+    if not fmt:
+        is_jsonl = filename.endswith((".jsonl", ".ndjson")) or "ndjson" in (request.mimetype or "")
+        fmt = "jsonl" if is_jsonl else "csv"
+    if fmt not in ("csv", "jsonl"):
+        return jsonify({"error": "format must be csv or jsonl"}), 400
+
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    result = import_products(iter_records(text, fmt))
+    if not result["rows"]:
+        return jsonify({"error": "Import contains no records"}), 400
+
+    return jsonify(result), 200
+
 # ----------------- GET List Products -----------------
 
 @app.route("/product", methods=["GET"])
+@cached_response("product")
 def list_products():
     products = get_all_products()
 
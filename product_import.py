@@ -0,0 +1,169 @@
+"""
+Bulk product catalog import.
+
+Reads a CSV (header: name,price) or JSON-lines ({"name": ..., "price": ...})
+file as a stream and imports it in chunks: each chunk needs one query to find
+names that already exist and one multi-row INSERT.
+
+    python product_import.py catalog.csv
+    python product_import.py catalog.jsonl --format jsonl
+"""
+import argparse
+import csv
+import io
+import json
+import math
+import sys
+
+from db import (
+    get_existing_product_names,
+    insert_products_bulk,
+    normalise_product_name,
+    product_name_key
+)
+
+CHUNK_SIZE = 1000
+
+
+def iter_records(stream, fmt):
+    """
+    Yield raw records (dicts) from a text stream in csv or jsonl format
+    """
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+    elif fmt == "jsonl":
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield record if isinstance(record, dict) else {}
+    else:
+        raise ValueError(f"Unsupported format {fmt}")
+
+
+def _validate(record):
+    """
+    Return (name, price, None) or (name, None, error message)
+    """
+    name = record.get("name")
+    if not isinstance(name, str) or not name.strip():
+        return None, None, "Product name cannot be blank"
+    name = normalise_product_name(name)
+
+    price = record.get("price")
+    if isinstance(price, bool):
+        return name, None, "Price must be a number"
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        return name, None, "Price must be a number"
+    if not math.isfinite(price):
+        return name, None, "Price must be a finite number"
+    if price <= 0:
+        return name, None, "Price must be greater than 0"
+
+    return name, price, None
+
+
+def _import_chunk(chunk, seen, report):
+    """
+    Check a chunk of (row, name, price) against the table and insert the new ones
+    """
+    try:
+        existing = get_existing_product_names([name for _, name, _ in chunk])
+    except Exception as e:
+        for row, name, _ in chunk:
+            report.append({"row": row, "name": name, "status": "error", "error": str(e)})
+        return
+
+    to_insert = []
+    pending = []
+    for row, name, price in chunk:
+        key = product_name_key(name)
+        if key in existing:
+            report.append({"row": row, "name": name, "status": "exists"})
+        elif key in seen:
+            report.append({"row": row, "name": name, "status": "duplicate",
+                           "error": f"Duplicate of row {seen[key]}"})
+        else:
+            seen[key] = row
+            to_insert.append((name, price))
+            pending.append({"row": row, "name": name})
+
+    # The chunk is one INSERT statement, so it either lands whole or not at all
+    try:
+        insert_products_bulk(to_insert)
+    except Exception as e:
+        for entry in pending:
+            entry.update(status="error", error=str(e))
+    else:
+        for entry in pending:
+            entry["status"] = "inserted"
+    report.extend(pending)
+
+
+def import_products(records, chunk_size=CHUNK_SIZE):
+    """
+    Import product records and return a per-row report plus summary counts
+    """
+    report = []
+    seen = {}
+    chunk = []
+
+    for row, record in enumerate(records, start=1):
+        name, price, error = _validate(record)
+        if error:
+            report.append({"row": row, "name": name, "status": "invalid", "error": error})
+            continue
+
+        key = product_name_key(name)
+        if key in seen:
+            report.append({"row": row, "name": name, "status": "duplicate",
+                           "error": f"Duplicate of row {seen[key]}"})
+            continue
+
+        chunk.append((row, name, price))
+        if len(chunk) >= chunk_size:
+            _import_chunk(chunk, seen, report)
+            chunk = []
+
+    if chunk:
+        _import_chunk(chunk, seen, report)
+
+    report.sort(key=lambda entry: entry["row"])
+    summary = {}
+    for entry in report:
+        summary[entry["status"]] = summary.get(entry["status"], 0) + 1
+
+    return {"summary": summary, "rows": report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import products")
+    parser.add_argument("file", help="CSV or JSON-lines file, '-' for stdin")
+    parser.add_argument("--format", choices=("csv", "jsonl"),
+                        help="defaults to the file extension, else csv")
+    parser.add_argument("--report", help="write the per-row report as JSON to this file")
+    args = parser.parse_args()
+
+    fmt = args.format or ("jsonl" if args.file.endswith((".jsonl", ".ndjson")) else "csv")
+    if args.file == "-":
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    else:
+        stream = open(args.file, encoding="utf-8", newline="")
+
+    with stream:
+        result = import_products(iter_records(stream, fmt))
+
+    print(json.dumps(result["summary"]))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(result["rows"], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Rendered-response cache and negotiated compression.
+
+cached_response() caches the rendered body of a GET list route per path and
+query string, together with its gzip/brotli encodings, and drops entries when
+db.py reports a write to a table the route depends on. Cache misses are
+rendered with the normal read routing, so with replicas an entry may hold
+data up to the replication lag old; like writes from other processes, that
+staleness is bounded by CACHE_TTL_SECONDS.
+compress_response() is an after_request hook that compresses other large JSON
+responses. Brotli is used only when the optional brotli package is installed.
+
+Invalidation only sees writes made by this process: the product_import CLI,
+other app workers or direct SQL changes are also picked up when the entry's
+CACHE_TTL_SECONDS runs out.
+"""
+import gzip
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, make_response
+
+from db import register_write_listener
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+MAX_CACHED_RESPONSES = 256
+# Upper bound on staleness from replica lag and writes this process does not see
+CACHE_TTL_SECONDS = 30
+
+
+def choose_encoding(accept_encoding):
+    """
+    Pick br or gzip from an Accept-Encoding header, honouring q=0
+    """
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.lower()] = q
+
+    def allowed(coding):
+        return accepted.get(coding, accepted.get("*", 0)) > 0
+
+    if brotli is not None and allowed("br"):
+        return "br"
+    if allowed("gzip"):
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _set_body(response, body, encoding):
+    response.set_data(body)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+
+
+class RenderedCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+
+    def generation(self, tables):
+        with self._lock:
+            return tuple(self._generations.get(table, 0) for table in tables)
+
+    def invalidate(self, table):
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+            for key in [key for key, entry in self._entries.items() if table in entry["tables"]]:
+                del self._entries[key]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires"] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, tables, generation, entry):
+        """
+        Store entry unless one of its tables was written while it was rendered
+        """
+        with self._lock:
+            if tuple(self._generations.get(table, 0) for table in tables) != generation:
+                return
+            entry["tables"] = tables
+            entry["expires"] = time.monotonic() + CACHE_TTL_SECONDS
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+rendered_cache = RenderedCache(MAX_CACHED_RESPONSES)
+for _table in ("product", "batch"):
+    register_write_listener(_table, lambda ids, table=_table: rendered_cache.invalidate(table))
+
+
+def cached_response(*tables):
+    """
+    Cache the rendered response of a GET view until one of tables is written
+    or CACHE_TTL_SECONDS pass
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = rendered_cache.get(key)
+
+            if entry is None:
+                generation = rendered_cache.generation(tables)
+                response = make_response(view(*args, **kwargs))
+                if response.status_code >= 500:
+                    return response
+                entry = {
+                    "status": response.status_code,
+                    "mimetype": response.mimetype,
+                    "body": response.get_data(),
+                    "encoded": {}
+                }
+                rendered_cache.put(key, tables, generation, entry)
+
+            response = make_response(entry["body"], entry["status"])
+            response.mimetype = entry["mimetype"]
+            encoding = None
+            if len(entry["body"]) >= MIN_COMPRESS_SIZE:
+                encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+            if encoding:
+                if encoding not in entry["encoded"]:
+                    entry["encoded"][encoding] = compress(entry["body"], encoding)
+                _set_body(response, entry["encoded"][encoding], encoding)
+            else:
+                response.vary.add("Accept-Encoding")
+            return response
+        return wrapper
+    return decorator
+
+
+def compress_response(response):
+    """
+    after_request hook compressing large JSON responses that are not yet encoded
+    """
+    if (response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or response.mimetype != "application/json"):
+        return response
+
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding:
+        _set_body(response, compress(body, encoding), encoding)
+    return response
@@ -0,0 +1,80 @@
+"""
+Compact in-memory representation of product and batch records.
+
+Cursor rows are dicts with string keys and date objects. The record classes
+here use __slots__ and keep expiry dates as integer day numbers
+(date.toordinal()), which keeps in-memory indexes such as expiry_index
+small.
+"""
+from datetime import date
+
+
+def to_day(value):
+    return value.toordinal()
+
+
+def from_day(day):
+    return date.fromordinal(day)
+
+
+class ProductRecord:
+    __slots__ = ("id", "name", "price", "qty")
+
+    def __init__(self, id, name, price, qty):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.qty = qty
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row["id"], row["name"], row["price"], row["qty"])
+
+
+class BatchRecord:
+    __slots__ = ("batch_id", "product_id", "qty", "expiry_day", "version")
+
+    def __init__(self, batch_id, product_id, qty, expiry_day, version=0):
+        self.batch_id = batch_id
+        self.product_id = product_id
+        self.qty = qty
+        self.expiry_day = expiry_day
+        self.version = version
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            row["batch_id"],
+            row["product_id"],
+            row["qty"],
+            to_day(row["expiry_date"]),
+            row.get("version", 0)
+        )
+
+    @property
+    def expiry_date(self):
+        return from_day(self.expiry_day)
+
+    def to_stock_response(self):
+        return {
+            "batchId": self.batch_id,
+            "quantity": self.qty,
+            "expiryDate": str(self.expiry_date)
+        }
+
+
+def allocate_fifo(batches, quantity):
+    """
+    Take quantity from batches (already ordered by expiry) earliest first.
+    Returns a list of (batch, deduct_qty), or None if stock is insufficient
+    """
+    allocations = []
+    remaining = quantity
+    for batch in batches:
+        if remaining == 0:
+            break
+        deduct_qty = min(batch.qty, remaining)
+        if deduct_qty > 0:
+            allocations.append((batch, deduct_qty))
+            remaining -= deduct_qty
+    return allocations if remaining == 0 else None
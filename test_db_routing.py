@@ -0,0 +1,105 @@
+"""
+Read routing tests: fake connection factories stand in for MySQL.
+
+    python -m unittest test_db_routing
+"""
+import unittest
+
+import db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.lastrowid = None
+
+    def execute(self, query, params=()):
+        self.conn.server.queries.append(query)
+        if self.conn.server.fail_queries:
+            raise RuntimeError(f"{self.conn.server.name} query failed")
+        self.lastrowid = 1
+
+    def fetchall(self):
+        return [{"server": self.conn.server.name}]
+
+    def fetchone(self):
+        return {"server": self.conn.server.name}
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+
+    def cursor(self, dictionary=False, buffered=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServer:
+    def __init__(self, name):
+        self.name = name
+        self.fail_connect = False
+        self.fail_queries = False
+        self.queries = []
+
+    def connect(self):
+        if self.fail_connect:
+            raise ConnectionError(f"{self.name} unreachable")
+        return FakeConnection(self)
+
+
+class ReadRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.primary = FakeServer("primary")
+        self.replicas = [FakeServer("r1"), FakeServer("r2")]
+        db.configure_connections(self.primary.connect, [r.connect for r in self.replicas])
+        db.reset_read_routing()
+
+    def tearDown(self):
+        db.reset_read_routing()
+
+    def read(self):
+        return db.get_product_by_id(1)["server"]
+
+    def test_round_robin_across_replicas(self):
+        self.assertEqual([self.read() for _ in range(4)], ["r1", "r2", "r1", "r2"])
+        self.assertEqual(self.primary.queries, [])
+
+    def test_connect_failure_skips_replica(self):
+        self.replicas[1].fail_connect = True
+        self.assertEqual([self.read() for _ in range(4)], ["r1", "r1", "r1", "r1"])
+
+    def test_query_failure_retries_on_primary_and_marks_replica_down(self):
+        self.replicas[0].fail_queries = True
+        self.assertEqual(self.read(), "primary")
+        self.assertEqual([self.read() for _ in range(3)], ["r2", "r2", "r2"])
+        self.assertEqual(len(self.replicas[0].queries), 1)
+
+    def test_all_replicas_down_falls_back_to_primary(self):
+        for replica in self.replicas:
+            replica.fail_connect = True
+        self.assertEqual(self.read(), "primary")
+
+    def test_reads_after_write_go_to_primary(self):
+        db.insert_batch(1, 10, "2030-01-01", "2026-01-01", "2026-01-01")
+        self.assertEqual([self.read() for _ in range(2)], ["primary", "primary"])
+
+        db.reset_read_routing()
+        self.assertEqual(self.read(), "r1")
+
+    def test_without_replicas_reads_use_primary(self):
+        db.configure_connections(self.primary.connect)
+        self.assertEqual(self.read(), "primary")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+Lightweight span tracing.
+
+Spans are written one JSON object per line to TRACE_FILE using the OTLP span
+field names (traceId, spanId, parentSpanId, startTimeUnixNano, ...), so the
+file can be inspected directly or replayed into an OTLP collector. When
+TRACE_FILE is not set, spans are not recorded and cost almost nothing.
+"""
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+TRACE_FILE = os.environ.get("TRACE_FILE")
+
+_local = threading.local()
+_sink_lock = threading.Lock()
+_sink = None
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "attributes")
+
+    def __init__(self, name, trace_id, span_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.attributes = attributes
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _attribute_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _export(record):
+    global _sink
+    line = json.dumps(record) + "\n"
+    with _sink_lock:
+        if _sink is None:
+            _sink = open(TRACE_FILE, "a", buffering=1)
+        _sink.write(line)
+
+
+def start_span(name, **attributes):
+    """
+    Start a span as a child of the current one on this thread
+    """
+    if not TRACE_FILE:
+        return _NOOP_SPAN
+
+    stack = _stack()
+    if stack:
+        parent = stack[-1]
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    else:
+        trace_id, parent_id = "%032x" % random.getrandbits(128), None
+
+    new_span = Span(name, trace_id, "%016x" % random.getrandbits(64), parent_id, attributes)
+    stack.append(new_span)
+    return new_span
+
+
+def end_span(current, error=None):
+    """
+    Finish a span started with start_span and write it to the sink
+    """
+    if current is _NOOP_SPAN:
+        return
+
+    stack = _stack()
+    if current in stack:
+        stack.remove(current)
+
+    record = {
+        "traceId": current.trace_id,
+        "spanId": current.span_id,
+        "parentSpanId": current.parent_id or "",
+        "name": current.name,
+        "startTimeUnixNano": str(current.start_ns),
+        "endTimeUnixNano": str(time.time_ns()),
+        "attributes": [
+            {"key": key, "value": _attribute_value(value)}
+            for key, value in current.attributes.items()
+        ],
+        "status": {"code": 2, "message": str(error)} if error else {"code": 1}
+    }
+    _export(record)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Trace the enclosed block:
+
+        with span("order.allocate", attempt=1) as s:
+            ...
+            s.set_attribute("deductions", len(deductions))
+    """
+    current = start_span(name, **attributes)
+    try:
+        yield current
+    except Exception as e:
+        end_span(current, e)
+        raise
+    end_span(current)
+
+
+def traced(name):
+    """
+    Decorator tracing every call of the wrapped function as a span
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator